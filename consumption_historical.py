@@ -4,165 +4,287 @@ Fetch historical consumption data from Tibber API and store in InfluxDB.
 """
 import os
 import argparse
-import requests
+import asyncio
+import aiohttp
 import datetime
 import base64
+import functools
 import logging
-from influxdb_client import InfluxDBClient
-from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client import Point, WritePrecision
+from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync
+
+# Prefer the faster orjson parser when it is installed
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 # Set up logging
 LOGLEVEL = os.environ.get('LOGLEVEL', 'INFO').upper()
 logging.basicConfig(level=LOGLEVEL)
 
-def query_price_level_for_period(client, db_name, start_time, end_time, org):
+async def query_price_levels_for_period(client, db_name, start_time, end_time, org):
     """
-    Query the price level data from InfluxDB for a specific period.
+    Query all price levels from InfluxDB for a period in a single query.
+
+    :return: Dict mapping the start time of each price to its level
     """
     query_api = client.query_api()
     query = f"""from(bucket: "{db_name}")
             |> range(start: {start_time}, stop: {end_time})
-            |> filter(fn: (r) => r._measurement == "energy_prices")
-            |> filter(fn: (r) => r._field == "total" or r._field == "level")
+            |> filter(fn: (r) => r._measurement == "energy_prices" and r._field == "total")
+            |> keep(columns: ["_time", "level"])
+    """
+
+    tables = await query_api.query(query, org=org)
+
+    return {record.get_time(): record.values['level'] for table in tables for record in table.records}
+
+
+# Number of hourly records requested per consumption window (server maximum)
+PAGE_SIZE = 1000
+
+# Maximum number of aliased consumption windows sent in one GraphQL request
+MAX_WINDOWS = 8
+
+# Number of fetched pages buffered while InfluxDB writes are in progress
+QUEUE_SIZE = 4
+
+CONSUMPTION_WINDOW = """
+      w%d: consumption(resolution: HOURLY, first: %d, after: $c%d) {
+        pageInfo {
+          endCursor
+          hasNextPage
+          count
+        }
+        nodes {
+          from
+          to
+          cost
+          consumption
+          unitPrice
+          unitPriceVAT
+        }
+      }
+"""
+
+
+def build_window_cursors(after_cursor):
     """
-    
-    tables = query_api.query(query, org=org)
+    Split the period between the after cursor and now into windows of PAGE_SIZE hours.
 
-    if len(tables) == 0 or len(tables[0].records) == 0:
-        logging.warning(f"No price level found for period {start_time} - {end_time}")
-        return "NORMAL"
-    
-    return tables[0].records[0].values['level']
+    :param after_cursor: Cursor for pagination in base64 encoded format
+    :return: List of base64 encoded cursors, one per window
+    """
+    try:
+        start = datetime.datetime.fromisoformat(base64.b64decode(after_cursor).decode())
+    except ValueError:
+        # Not a timestamp cursor, fall back to a single window
+        return [after_cursor]
+
+    now = datetime.datetime.now(start.tzinfo)
+    window = datetime.timedelta(hours=PAGE_SIZE)
+    cursors = [after_cursor]
+    cursor_time = start + window
+    while cursor_time < now and len(cursors) < MAX_WINDOWS:
+        cursors.append(base64.b64encode(cursor_time.isoformat().encode()).decode())
+        cursor_time += window
+    return cursors
+
+
+@functools.lru_cache(maxsize=MAX_WINDOWS)
+def build_consumption_query(window_count):
+    """
+    Build a GraphQL query requesting aliased consumption windows. The cursor of
+    window i is passed as variable c<i>, so the query only depends on the number
+    of windows and is built once per count.
+
+    :param window_count: Number of consumption windows
+    :return: GraphQL query string
+    """
+    variables = ", ".join("$c%d: String!" % i for i in range(window_count))
+    windows = "".join(CONSUMPTION_WINDOW % (i, PAGE_SIZE, i) for i in range(window_count))
+    return """
+    query Consumption(%s) {
+      viewer {
+        homes {
+    %s
+        }
+      }
+    }
+    """ % (variables, windows)
+
+
+def reaches(window, next_window):
+    """
+    Check that the window reaches the first record of the next window, windows may overlap.
+    """
+    if not window['nodes'] or not next_window['nodes']:
+        return False
+    end = datetime.datetime.fromisoformat(window['nodes'][-1]['to'])
+    first = datetime.datetime.fromisoformat(next_window['nodes'][0]['from'])
+    return end >= first
 
 
-def fetch_historical_consumption(api_token, after_cursor):
+async def fetch_historical_consumption(session, after_cursor):
     """
     Fetch historical consumption data from the Tibber API until hasNextPage is false.
 
-    :param api_token: API token for authentication
+    Several windows of PAGE_SIZE hours are requested in a single GraphQL query
+    using aliases to reduce the number of round trips.
+
+    :param session: aiohttp session authenticated for the Tibber API
     :param after_cursor: Cursor for pagination in base64 encoded format
-    :return: List of all historical consumption data records
+    :return: Async iterator over pages of historical consumption data records
     """
-    all_consumption_data = []
+    seen = set()
+
+    # Endpoint for the Tibber API
+    url = 'https://api.tibber.com/v1-beta/gql'
 
     while True:
         try:
-            # Endpoint for the Tibber API
-            url = 'https://api.tibber.com/v1-beta/gql'
-            headers = {
-                'Authorization': f'Bearer {api_token}',
-                'Content-Type': 'application/json'
-            }
-
-            # GraphQL query with pagination
-            query = """
-            {
-              viewer {
-                homes {
-                  consumption(resolution: HOURLY, first: 100, after: "%s") {
-                    pageInfo {
-                      endCursor
-                      hasNextPage
-                      count
-                    }
-                    nodes {
-                      from
-                      to
-                      cost
-                      consumption
-                      unitPrice
-                      unitPriceVAT
-                    }
-                  }
-                }
-              }
+            cursors = build_window_cursors(after_cursor)
+            payload = {
+                'query': build_consumption_query(len(cursors)),
+                'operationName': 'Consumption',
+                'variables': {'c%d' % i: cursor for i, cursor in enumerate(cursors)}
             }
-            """ % after_cursor
 
             # Make the request
-            response = requests.post(url, json={'query': query}, headers=headers)
-            data = response.json()
+            async with session.post(url, json=payload) as response:
+                content = await response.read()
+            data = json_loads(content)
 
             # Check for errors in response
-            if response.status_code != 200 or "errors" in data:
-                logging.error("Failed to fetch data: %s", response.text)
+            if response.status != 200 or "errors" in data:
+                logging.error("Failed to fetch data: %s", content.decode())
                 break
 
-            # Extract consumption data
-            consumption_data = data['data']['viewer']['homes'][0]['consumption']
-            all_consumption_data.extend(consumption_data['nodes'])
+            # Extract consumption data, windows may overlap if hours are missing
+            home = data['data']['viewer']['homes'][0]
+            windows = [home['w%d' % i] for i in range(len(cursors))]
+            page = []
+            for i, consumption_data in enumerate(windows):
+                logging.debug("Window %s returned %s records", i, consumption_data['pageInfo']['count'])
+                for node in consumption_data['nodes']:
+                    if node['from'] not in seen:
+                        seen.add(node['from'])
+                        page.append(node)
+                if not consumption_data['pageInfo']['hasNextPage']:
+                    break
+                # Continue from the end cursor if the predicted next window leaves a gap
+                if i + 1 < len(windows) and not reaches(consumption_data, windows[i + 1]):
+                    logging.debug("Window %s does not reach window %s, continuing from its end cursor", i, i + 1)
+                    break
+            yield page
 
-            # Pagination check
+            # Pagination check on the last used window
             if not consumption_data['pageInfo']['hasNextPage']:
                 break
             after_cursor = consumption_data['pageInfo']['endCursor']
 
-        except requests.RequestException as e:
+        except aiohttp.ClientError as e:
             logging.error("Request failed: %s", e)
             break
         except Exception as e:
             logging.error("An error occurred: %s", e)
             break
 
-    return all_consumption_data
-
-def store_in_influxdb(data, bucket_name, url, token, org):
+async def store_in_influxdb(client, data, bucket_name, org):
     """
     Store the consumption data in an InfluxDB database.
 
+    :param client: Async InfluxDB client
     :param data: Data to store
-    :param db_name: Name of the InfluxDB database
-    :param host: Host of the InfluxDB instance
-    :param port: Port of the InfluxDB instance
-    :param username: Username for InfluxDB
-    :param password: Password for InfluxDB
+    :param bucket_name: Name of the InfluxDB bucket
+    :param org: Organization for InfluxDB
     """
-    org = "myOrg"
     try:
-        client = InfluxDBClient(url=url, token=token, org=org)
-
-        # Create the database if it doesn't exist
-        bucket = client.buckets_api().find_bucket_by_name(bucket_name)
-        if bucket is None:
-            logging.error("Bucket %s does not exist", bucket_name)
-            return
-
-
-        influx_data = []
-        for record in data:
-
-            price_level = query_price_level_for_period(client, bucket_name, record['from'], record['to'], org=org)
-
-            if price_level == 'unknown':
-                logging.warning("No price level found for %s", record['from'])
-                return
-            if record['consumption'] is not None and float(record['consumption']) is not None:
-                influx_record = {
-                    "measurement": "historical_consumption",
-                    "time": record['from'],
-                    "tags": {
-                        "level": price_level
-                    },
-                    "fields": {
-                        "cost": float(record['cost']),
-                        "consumption": float(record['consumption']),
-                        "unitPrice": float(record['unitPrice']),
-                        "unitPriceVAT": float(record['unitPriceVAT'])
-                    }
-                }
-                influx_data.append(influx_record)
+        # Look up the price levels of all records at once
+        start_times = [datetime.datetime.fromisoformat(record['from']) for record in data]
+        end_time = max(datetime.datetime.fromisoformat(record['to']) for record in data)
+        price_levels = await query_price_levels_for_period(client, bucket_name, min(start_times).isoformat(), end_time.isoformat(), org=org)
+
+        missing = sum(1 for start_time in start_times if start_time not in price_levels)
+        if missing:
+            logging.warning("No price level found for %s records, using NORMAL", missing)
+
+        points = [
+            Point("historical_consumption")
+            .tag("level", price_levels.get(start_time, "NORMAL"))
+            .field("cost", float(record['cost']))
+            .field("consumption", float(record['consumption']))
+            .field("unitPrice", float(record['unitPrice']))
+            .field("unitPriceVAT", float(record['unitPriceVAT']))
+            .time(record['from'], WritePrecision.S)
+            for start_time, record in zip(start_times, data)
+            if record['consumption'] is not None
+        ]
 
         # Write data to InfluxDB
-        write_api = client.write_api(write_options=SYNCHRONOUS)
-        write_api.write(bucket=bucket_name, org=org, record=influx_data)
+        await client.write_api().write(bucket=bucket_name, org=org, record=points)
         logging.info("Historical consumption data written to InfluxDB")
 
-        # Close the client connection
-        client.close()
-
     except Exception as e:
         logging.error("An error occurred while writing to InfluxDB: %s", e)
 
+
+async def fetch_pages(session, after_cursor, queue):
+    """
+    Producer putting fetched pages on the queue, followed by None when done.
+    """
+    try:
+        async for page in fetch_historical_consumption(session, after_cursor):
+            if page:
+                await queue.put(page)
+    finally:
+        await queue.put(None)
+
+
+async def store_pages(client, queue, bucket_name, org):
+    """
+    Consumer storing pages from the queue until None is received.
+
+    :return: Number of records and the last record stored
+    """
+    record_count = 0
+    last_record = None
+    while True:
+        page = await queue.get()
+        if page is None:
+            return record_count, last_record
+        await store_in_influxdb(client, page, bucket_name, org)
+        record_count += len(page)
+        last_record = page[-1]
+
+
+async def main(args):
+    # Encode timestamp to base64 for after_cursor
+    after_cursor = base64.b64encode(args.timestamp.encode()).decode()
+
+    headers = {
+        'Authorization': f'Bearer {args.api_token}',
+        'Content-Type': 'application/json',
+        'Accept-Encoding': 'gzip'
+    }
+    connector = aiohttp.TCPConnector(limit=4, keepalive_timeout=60)
+    timeout = aiohttp.ClientTimeout(total=30)
+
+    # Fetch the next pages from Tibber while the previous ones are written to InfluxDB
+    queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    async with aiohttp.ClientSession(headers=headers, connector=connector, timeout=timeout) as session, \
+            InfluxDBClientAsync(url=args.influxdb_url, token=args.influxdb_token, org=args.influxdb_org, enable_gzip=True) as client:
+        _, (record_count, last_record) = await asyncio.gather(
+            fetch_pages(session, after_cursor, queue),
+            store_pages(client, queue, args.influxdb_bucket, args.influxdb_org))
+
+    logging.info("Fetched %s historical consumption data records", record_count)
+    if last_record is not None:
+        logging.info("Historical consumption data stored till %s", last_record['from'])
+    else:
+        logging.info("No historical consumption data available to store in InfluxDB")
+
 # Set up argparse for command line arguments
 parser = argparse.ArgumentParser(description='Fetch historical consumption data from Tibber API and store in InfluxDB.')
 parser.add_argument('--api_token', type=str, default=os.environ.get('API_TOKEN'), help='API token for the Tibber API')
@@ -174,16 +296,4 @@ parser.add_argument('--influxdb_org', type=str, default=os.environ.get('INFLUX_O
 
 args, unknown = parser.parse_known_args()
 
-# Encode timestamp to base64 for after_cursor
-after_cursor = base64.b64encode(args.timestamp.encode()).decode()
-
-# Fetch historical consumption data
-historical_consumption_data = fetch_historical_consumption(args.api_token, after_cursor)
-logging.info("Fetched %s historical consumption data records", len(historical_consumption_data))
-
-# Store the records in the InfluxDB database
-if historical_consumption_data:
-    store_in_influxdb(historical_consumption_data, args.influxdb_bucket, args.influxdb_url, args.influxdb_token, args.influxdb_org)
-    logging.info("Historical consumption data stored till %s", historical_consumption_data[-1]['from'])
-else:
-    logging.info("No historical consumption data available to store in InfluxDB")
+asyncio.run(main(args))
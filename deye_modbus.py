@@ -7,26 +7,43 @@ Scrape real-time data from Deye inverter and store in InfluxDB.
 import os
 import argparse
 import logging
+import select
 import socket
+import struct
 import time
-import datetime
-import libscrc
+import functools
+from binascii import hexlify, unhexlify
+import numpy as np
+from fastcrc import crc16
 
-from influxdb_client import InfluxDBClient
+from influxdb_client import InfluxDBClient, Point, WritePrecision
 from influxdb_client.client.write_api import SYNCHRONOUS
 
+# Seconds to wait for the inverter to answer an AT command before sending the next one
+AT_PACING_TIMEOUT = 0.1
+
 
 def build_modbus_read_holding_registers_request_frame(first_reg: int, last_reg: int) -> bytearray:
         reg_count = last_reg - first_reg + 1
         return bytearray.fromhex("0103{:04x}{:04x}".format(first_reg, reg_count))
 
+@functools.lru_cache(maxsize=32)
+def build_modbus_read_holding_registers_request(first_reg: int, last_reg: int) -> bytes:
+        """
+        Build the complete read holding registers request including the crc. The result only depends
+        on the register range, so it is cached across polls.
+        """
+        modbus_frame = bytes(build_modbus_read_holding_registers_request_frame(first_reg, last_reg))
+        return modbus_frame + crc16.modbus(modbus_frame).to_bytes(2, "little")
+
 def parse_modbus_read_holding_registers_response(frame: bytes, first_reg: int, last_reg: int
-    ) -> dict[int, bytearray]:
+    ) -> dict:
         """
         Parse a response from a modbus read holding registers request. The frame is a bytes object
         containing the bytes of the response, excluding the slave address. The first_reg and last_reg
         arguments are the register addresses requested in the original request. The returned value
-        is a dictionary mapping register addresses to the values of the registers.
+        is a dictionary holding the address of the first register under "first" and all register
+        values as a big-endian uint16 array under "u16".
         """
 
         # Verify that the frame is long enough to contain the expected number of registers
@@ -38,7 +55,7 @@ def parse_modbus_read_holding_registers_response(frame: bytes, first_reg: int, l
 
         # Verify that the crc is correct
         actual_crc = int.from_bytes(frame[expected_frame_data_len : expected_frame_data_len + 2], "little")
-        expected_crc = libscrc.modbus(frame[0:expected_frame_data_len])
+        expected_crc = crc16.modbus(bytes(memoryview(frame)[:expected_frame_data_len]))
         if actual_crc != expected_crc:
             logging.error(
                 "Modbus frame crc is not valid. Expected {:04x}, got {:04x}".format(expected_crc, actual_crc)
@@ -46,14 +63,7 @@ def parse_modbus_read_holding_registers_response(frame: bytes, first_reg: int, l
             raise ValueError("Modbus frame crc is not valid")
         
         # Parse the register values from the frame
-        registers = {}
-        a = 0
-        while a < reg_count:
-            p1 = 3 + (a * 2)
-            p2 = p1 + 2
-            registers[a + first_reg] = frame[p1:p2]
-            a += 1
-        return registers
+        return {"first": first_reg, "u16": np.frombuffer(frame, dtype=">u2", count=reg_count, offset=3)}
 
 class DeyeAtConnector():
     def __init__(self, host: str, port: int = 48899) -> None:
@@ -80,28 +90,22 @@ class DeyeAtConnector():
     def __send_at_command(self, client_socket: socket, at_command: str) -> None:
         logging.debug("Sending AT command: %s", at_command)
         client_socket.sendto(at_command, (self._host, self._port))
-        time.sleep(0.1)
+        # Continue as soon as the inverter answers
+        select.select([client_socket], [], [], AT_PACING_TIMEOUT)
 
     def __receive_at_response(self, client_socket: socket) -> str:
-        attempts = 5
-        while attempts > 0:
-            attempts = attempts - 1
-            try:
-                data = client_socket.recv(1024)
-                if data:
-                    logging.debug("Received AT response in %s. attempt: %s", 5 - attempts, data)
-                    return data
-                logging.warning("No data received")
-            except socket.timeout:
-                logging.debug("Connection response timeout")
-                if attempts == 0:
-                    logging.warning("Too many connection timeouts")
-            except OSError as e:
-                logging.error("Connection error: %s: %s", self.config.ip_address, e)
-                return
-            except Exception:
-                logging.exception("Unknown connection error")
-                return
+        try:
+            data = client_socket.recv(1024)
+            if data:
+                logging.debug("Received AT response: %s", data)
+                return data
+            logging.warning("No data received")
+        except socket.timeout:
+            logging.warning("Connection response timeout")
+        except OSError as e:
+            logging.error("Connection error: %s: %s", self._host, e)
+        except Exception:
+            logging.exception("Unknown connection error")
         return
 
     def __authenticate(self, client_socket) -> None:
@@ -122,11 +126,9 @@ class DeyeAtConnector():
             self.__authenticate(client_socket)
             self.__send_at_command(client_socket, b"+ok")
 
-            modbus_frame_str = req_frame.hex()
             self.__send_at_command(
-                client_socket, bytes(f"AT+INVDATA={int(len(modbus_frame_str) / 2)},{modbus_frame_str}\n", "ascii")
+                client_socket, b"AT+INVDATA=" + str(len(req_frame)).encode() + b"," + hexlify(req_frame) + b"\n"
             )
-            time.sleep(1/10.0)
             at_response = self.__receive_at_response(client_socket)
             if not at_response or at_response.startswith(b"+ok=no data"):
                 logging.warning(f'No data received for request: {at_response}')
@@ -148,13 +150,13 @@ class DeyeAtConnector():
 
     @staticmethod
     def extract_modbus_respose(at_cmd_response: bytes) -> bytes:
-        extracted_modus_response = at_cmd_response.replace(b"\x10", b"")[4:-4].decode("utf-8")
-        if len(extracted_modus_response) > 4 and extracted_modus_response[-4:] == "0000":
-            extracted_modus_response = extracted_modus_response[0:-4]
-        return bytearray.fromhex(extracted_modus_response)
+        extracted_modus_response = at_cmd_response.replace(b"\x10", b"")[4:-4]
+        if len(extracted_modus_response) > 4 and extracted_modus_response.endswith(b"0000"):
+            extracted_modus_response = extracted_modus_response[:-4]
+        return unhexlify(extracted_modus_response)
 
 
-def read_holding_registers(connector: DeyeAtConnector, first_reg: int, last_reg: int) -> dict[int, bytearray]:
+def read_holding_registers(connector: DeyeAtConnector, first_reg: int, last_reg: int) -> dict:
         """Reads multiple modbus holding registers
 
         Args:
@@ -162,14 +164,10 @@ def read_holding_registers(connector: DeyeAtConnector, first_reg: int, last_reg:
             last_reg (int): The address of the last register to read
 
         Returns:
-            dict[int, bytearray]: Map of register values, where the register address is the map key,
-            and register value is the map value
+            dict: Address of the first register under "first" and the register values as a
+            big-endian uint16 array under "u16"
         """
-        modbus_frame = build_modbus_read_holding_registers_request_frame(first_reg, last_reg)
-        modbus_crc = bytearray.fromhex("{:04x}".format(libscrc.modbus(modbus_frame)))
-        modbus_crc.reverse()
-
-        modbus_resp_frame = connector.send_request(modbus_frame + modbus_crc)
+        modbus_resp_frame = connector.send_request(build_modbus_read_holding_registers_request(first_reg, last_reg))
         if modbus_resp_frame is None:
             return None
         return parse_modbus_read_holding_registers_response(modbus_resp_frame, first_reg, last_reg)
@@ -196,43 +194,48 @@ fields = [
     ]
 '''
 
-def read_unit16(response: dict[int, bytearray], address: int) -> int:
-    return int.from_bytes(response[address], "big") & 0xffff
-
-def read_unit32(response: dict[int, bytearray], address: int) -> int:
-    return int.from_bytes(response[address], "big") & 0xffffffff
-
-def read_int16(response: dict[int, bytearray], address: int) -> int:
-    value = int.from_bytes(response[address], "big") & 0xffff
-    if value > 32767:
-        value = value - 65536
-    return value
-
-def read_int32(response: dict[int, bytearray], address: int) -> int:
-    value = read_unit32(response, address)
-    if value > 2147483647:
-        value = value - 4294967296
-    return value
-
-def get_fields_from_response(response: dict[int, bytearray]) -> dict[str, float]:
-    fields = {}
-    fields["day_energy"] = read_unit16(response, 60) * 0.1
+_U16 = struct.Struct(">H").unpack_from
+
+def read_unit16(response: dict, address: int) -> int:
+    return _U16(response["u16"], 2 * (address - response["first"]))[0]
+
+# Scaled fields by register type as (name, address, scale). The 32 bit fields
+# (total_energy, pv1_total_energy, pv2_total_energy and the signed active_power)
+# are read from a single unsigned register, as the original 32 bit readers did.
+UNSIGNED_FIELDS = (
+    ("day_energy", 60, 0.1),
+    ("total_energy", 63, 0.1),
+    ("pv1_day_energy", 65, 0.1),
+    ("pv2_day_energy", 66, 0.1),
+    ("pv1_total_energy", 69, 0.1),
+    ("pv2_total_energy", 71, 0.1),
+    ("active_power", 86, 0.1),
+)
+SIGNED_FIELDS = (
+    ("l1_voltage", 73, 0.1),
+    ("l1_current", 76, 0.1),
+    ("freq", 79, 0.01),
+    ("operating_power", 80, 0.01),
+    ("radiator_temp", 90, 0.01),
+    ("pv1_voltage", 109, 0.1),
+    ("pv1_current", 110, 0.1),
+    ("pv2_voltage", 111, 0.1),
+    ("pv2_current", 112, 0.1),
+)
+
+_FIELD_NAMES = [name for name, _, _ in UNSIGNED_FIELDS + SIGNED_FIELDS]
+_UNSIGNED_ADDRS = np.array([address for _, address, _ in UNSIGNED_FIELDS])
+_UNSIGNED_SCALES = np.array([scale for _, _, scale in UNSIGNED_FIELDS])
+_SIGNED_ADDRS = np.array([address for _, address, _ in SIGNED_FIELDS])
+_SIGNED_SCALES = np.array([scale for _, _, scale in SIGNED_FIELDS])
+
+def get_fields_from_response(response: dict) -> dict[str, float]:
+    first = response["first"]
+    registers = response["u16"]
+    unsigned = registers[_UNSIGNED_ADDRS - first] * _UNSIGNED_SCALES
+    signed = registers.view(">i2")[_SIGNED_ADDRS - first] * _SIGNED_SCALES
+    fields = dict(zip(_FIELD_NAMES, np.round(np.concatenate((unsigned, signed)), 2).tolist()))
     fields["uptime"] = read_unit16(response, 60)
-    fields["total_energy"] = read_unit32(response, 63) * 0.1
-    fields["pv1_day_energy"] = read_unit16(response, 65) * 0.1
-    fields["pv2_day_energy"] = read_unit16(response, 66) * 0.1
-    fields["pv1_total_energy"] = read_unit32(response, 69) * 0.1
-    fields["pv2_total_energy"] = read_unit32(response, 71) * 0.1
-    fields["l1_voltage"] = read_int16(response, 73) * 0.1
-    fields["l1_current"] = read_int16(response, 76) * 0.1
-    fields["freq"] = read_int16(response, 79) * 0.01
-    fields["operating_power"] = read_int16(response, 80) * 0.01
-    fields["active_power"] = read_int32(response, 86) * 0.1
-    fields["radiator_temp"] = read_int16(response, 90) * 0.01
-    fields["pv1_voltage"] = read_int16(response, 109) * 0.1
-    fields["pv1_current"] = read_int16(response, 110) * 0.1
-    fields["pv2_voltage"] = read_int16(response, 111) * 0.1
-    fields["pv2_current"] = read_int16(response, 112) * 0.1    
     return fields
 
 def store_in_influxdb(data, bucket_name:str, url:str, token:str, org:str, unit:str):
@@ -246,8 +249,8 @@ def store_in_influxdb(data, bucket_name:str, url:str, token:str, org:str, unit:s
     :param org: Organization for InfluxDB
     """
 
-    now = datetime.datetime.utcnow().isoformat() + "Z"
-    client = InfluxDBClient(url=url, token=token, org=org)
+    now_ns = time.time_ns()
+    client = InfluxDBClient(url=url, token=token, org=org, enable_gzip=True)
     try:
 
         # Create the database if it doesn't exist
@@ -258,78 +261,47 @@ def store_in_influxdb(data, bucket_name:str, url:str, token:str, org:str, unit:s
 
         # Convert data to InfluxDB format
         influx_data = []
-        influx_data.append({
-            "measurement": "operation",
-            "tags": {
-                "pv_unit": unit
-            },
-            "time": now,
-            "fields": {
-                "uptime": data['uptime'],
-                "operating_power": round(float(data['operating_power']), 2),
-                "radiator_temp": round(float(data['radiator_temp']), 2)
-            }
-        })
-
-        influx_data.append({
-            "measurement": "ac",
-            "tags": {
-                "pv_unit": unit
-            },
-            "time": now,
-            "fields": {
-                "day_energy": round(float(data['day_energy']), 2),
-                "total_energy": round(float(data['total_energy']), 2),
-                "freq": round(float(data['freq']), 2),
-                "active_power": round(float(data['active_power']), 2)
-            }
-        })
-
-        influx_data.append({
-            "measurement": "ac",
-            "tags": {
-                "pv_unit": unit,
-                "phase": "l1"
-            },
-            "time": now,
-            "fields": {
-                "voltage": round(float(data['l1_voltage']), 2),
-                "current": round(float(data['l1_current']), 2)
-            }
-        })
+        influx_data.append(Point("operation")
+            .tag("pv_unit", unit)
+            .field("uptime", data['uptime'])
+            .field("operating_power", data['operating_power'])
+            .field("radiator_temp", data['radiator_temp'])
+            .time(now_ns, WritePrecision.NS))
+
+        influx_data.append(Point("ac")
+            .tag("pv_unit", unit)
+            .field("day_energy", data['day_energy'])
+            .field("total_energy", data['total_energy'])
+            .field("freq", data['freq'])
+            .field("active_power", data['active_power'])
+            .time(now_ns, WritePrecision.NS))
+
+        influx_data.append(Point("ac")
+            .tag("pv_unit", unit)
+            .tag("phase", "l1")
+            .field("voltage", data['l1_voltage'])
+            .field("current", data['l1_current'])
+            .time(now_ns, WritePrecision.NS))
 
         # Add PV1 measurement
-        influx_data.append({
-            "measurement": "dc",
-            "tags": {
-                "pv_unit": unit,
-                "string": "pv1"
-            },
-            "time": now,
-            "fields": {
-                "voltage": round(float(data['pv1_voltage']), 2),
-                "current": round(float(data['pv1_current']), 2),
-                "day_energy": round(float(data['pv1_day_energy']), 2),
-                "total_energy": round(float(data['pv1_total_energy']), 2),
-            }
-        })
+        influx_data.append(Point("dc")
+            .tag("pv_unit", unit)
+            .tag("string", "pv1")
+            .field("voltage", data['pv1_voltage'])
+            .field("current", data['pv1_current'])
+            .field("day_energy", data['pv1_day_energy'])
+            .field("total_energy", data['pv1_total_energy'])
+            .time(now_ns, WritePrecision.NS))
 
         # Add PV2 measurement
-        influx_data.append({
-            "measurement": "dc",
-            "tags": {
-                "pv_unit": unit,
-                "string": "pv2"
-            },
-            "time": now,
-            "fields": {
-                "voltage": round(float(data['pv2_voltage']), 2),
-                "current": round(float(data['pv2_current']), 2),
-                "day_energy": round(float(data['pv2_day_energy']), 2),
-                "total_energy": round(float(data['pv2_total_energy']), 2)
-            }
-        })
-            
+        influx_data.append(Point("dc")
+            .tag("pv_unit", unit)
+            .tag("string", "pv2")
+            .field("voltage", data['pv2_voltage'])
+            .field("current", data['pv2_current'])
+            .field("day_energy", data['pv2_day_energy'])
+            .field("total_energy", data['pv2_total_energy'])
+            .time(now_ns, WritePrecision.NS))
 
         # Write data to InfluxDB
         write_api = client.write_api(write_options=SYNCHRONOUS)
@@ -2,55 +2,133 @@
 
 import os
 import argparse
+import asyncio
+import aiohttp
+import datetime
+from zoneinfo import ZoneInfo
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import base64
-from influxdb_client import InfluxDBClient
-from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client import WritePrecision
+from utils import influx_writer
 
 import logging
 
-def fetch_price_info_today(api_token):
+# Prefer the faster orjson parser when it is installed
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# Hour in the home's timezone after which Tibber publishes tomorrow's prices
+TOMORROW_PUBLISH_HOUR = 13
+
+# GraphQL query for today's and tomorrow's prices
+PRICE_INFO_QUERY = """
+{
+  viewer {
+    homes {
+      currentSubscription {
+        priceInfo {
+%s
+        }
+      }
+    }
+  }
+}
+"""
+TODAY_BLOCK = """
+          today {
+            total
+            startsAt
+            level
+          }
+"""
+TOMORROW_BLOCK = """
+          tomorrow {
+            total
+            startsAt
+            level
+          }
+"""
+
+# Number of hourly prices per page of the price range query
+PAGE_HOURS = 100
+
+# Number of price pages requested concurrently once the cursor format is known
+PREFETCH_PAGES = 4
+
+# Timeout in seconds and retries with backoff for each price page request
+PAGE_TIMEOUT = 30
+PAGE_RETRIES = 3
+PAGE_BACKOFF_FACTOR = 0.3
+
+# GraphQL query with pagination, the cursor is passed as variable
+PRICE_RANGE_QUERY = """
+query PriceRange($after: String!) {
+  viewer {
+    homes {
+      currentSubscription {
+        priceInfo {
+          range(first: %d, resolution: HOURLY, after: $after) {
+            pageInfo {
+              endCursor
+              hasNextPage
+              count
+            }
+            nodes {
+              total
+              startsAt
+              level
+            }
+          }
+        }
+      }
+    }
+  }
+}
+""" % PAGE_HOURS
+
+
+def create_session(api_token):
+    """
+    Create a session for the Tibber API reusing its connection across requests.
+
+    :param api_token: API token for authentication
+    :return: requests session
+    """
+    session = requests.Session()
+    session.headers.update({
+        'Authorization': f'Bearer {api_token}',
+        'Content-Type': 'application/json'
+    })
+    session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=Retry(total=3, backoff_factor=0.3)))
+    return session
+
+
+def fetch_price_info_today(api_token, timezone):
     """
     Fetch today's and tomorrow's price information from the Tibber API.
 
     :param api_token: API token for authentication
+    :param timezone: Timezone of the home, tomorrow's prices are requested after TOMORROW_PUBLISH_HOUR there
     :return: List of today's and tomorrow's price info records
     """
+    session = create_session(api_token)
     try:
         # Endpoint for the Tibber API
         url = 'https://api.tibber.com/v1-beta/gql'
-        headers = {
-            'Authorization': f'Bearer {api_token}',
-            'Content-Type': 'application/json'
-        }
 
-        # GraphQL query
-        query = """
-        {
-          viewer {
-            homes {
-              currentSubscription{
-                priceInfo{
-                  today {
-                    total
-                    startsAt
-                    level
-                  }
-                  tomorrow {
-                    total
-                    startsAt
-                    level
-                  }
-                }
-              }
-            }
-          }
-        }
-        """
+        # GraphQL query, tomorrow's prices are only published in the afternoon
+        prices = TODAY_BLOCK
+        if datetime.datetime.now(ZoneInfo(timezone)).hour >= TOMORROW_PUBLISH_HOUR:
+            prices += TOMORROW_BLOCK
+        query = PRICE_INFO_QUERY % prices
 
         # Make the request
-        response = requests.post(url, json={'query': query}, headers=headers)
-        data = response.json()
+        response = session.post(url, json={'query': query})
+        data = json_loads(response.content)
 
         # Check for errors in response
         if response.status_code != 200 or "errors" in data:
@@ -60,7 +138,7 @@ def fetch_price_info_today(api_token):
         # Extract today's and tomorrow's price information
         price_info = data['data']['viewer']['homes'][0]['currentSubscription']['priceInfo']
         today_prices = price_info['today']
-        tomorrow_prices = price_info['tomorrow']
+        tomorrow_prices = price_info.get('tomorrow', [])
 
         return today_prices + tomorrow_prices
 
@@ -70,119 +148,157 @@ def fetch_price_info_today(api_token):
     except Exception as e:
         logging.error("An error occurred: %s", e)
         return []
+    finally:
+        session.close()
 
 
-def fetch_all_price_info(api_token, after_cursor):
+async def fetch_price_range_page(session, after_cursor):
     """
-    Fetch all price information from the Tibber API.
+    Fetch one page of price information after the cursor.
 
-    :param api_token: API token for authentication
-    :param after_cursor: Cursor for pagination in ISO format and base64 encoded
-    :return: List of all price info records
+    :param session: aiohttp session authenticated for the Tibber API
+    :param after_cursor: Cursor for pagination in base64 encoded format
+    :return: Price range page with pageInfo and nodes or None on errors
     """
     # Endpoint for the Tibber API
     url = 'https://api.tibber.com/v1-beta/gql'
-    headers = {
-        'Authorization': f'Bearer {api_token}',
-        'Content-Type': 'application/json'
-    }
 
-    all_price_info = []
+    try:
+        for attempt in range(PAGE_RETRIES + 1):
+            try:
+                async with session.post(url, json={'query': PRICE_RANGE_QUERY, 'variables': {'after': after_cursor}}) as response:
+                    content = await response.read()
+                break
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == PAGE_RETRIES:
+                    raise
+                logging.debug("Request failed, retrying: %s", e)
+                await asyncio.sleep(PAGE_BACKOFF_FACTOR * 2 ** attempt)
+        data = json_loads(content)
 
-    while True:
-        # GraphQL query with pagination
-        query = """
-        {
-          viewer {
-            homes {
-              currentSubscription {
-                priceInfo {
-                  range(first: 100, resolution: HOURLY, after: "%s") {
-                    pageInfo {
-                      endCursor
-                      hasNextPage
-                      count
-                    }
-                    nodes {
-                      total
-                      startsAt
-                      level
-                    }
-                  }
-                }
-              }
-            }
-          }
-        }
-        """ % after_cursor
+        # Check for errors in response
+        if response.status != 200 or "errors" in data:
+            logging.error("Failed to fetch data: %s", content.decode())
+            return None
 
-        # Make the request
-        response = requests.post(url, json={'query': query}, headers=headers)
-        data = response.json()
+        return data['data']['viewer']['homes'][0]['currentSubscription']['priceInfo']['range']
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.error("Request failed: %s", e)
+        return None
+    except ValueError as e:
+        logging.error("Invalid response: %s", e)
+        return None
 
-        # Check for errors in response
-        if response.status_code != 200 or "errors" in data:
-            print("Failed to fetch data:", response.text)
-            break
 
-        # Extract price information
-        price_info = data['data']['viewer']['homes'][0]['currentSubscription']['priceInfo']['range']
-        all_price_info.extend(price_info['nodes'])
+def predict_cursors(end_cursor, count):
+    """
+    Predict the cursors of the following pages from the end cursor of the current page,
+    each page covers PAGE_HOURS hours.
+
+    :param end_cursor: End cursor of the current page in base64 encoded format
+    :param count: Number of cursors to return
+    :return: List of cursors starting with the end cursor itself
+    """
+    try:
+        end = datetime.datetime.fromisoformat(base64.b64decode(end_cursor).decode())
+    except ValueError:
+        # Unknown cursor format, continue sequentially
+        return [end_cursor]
+
+    return [end_cursor] + [
+        base64.b64encode((end + datetime.timedelta(hours=PAGE_HOURS * k)).isoformat().encode()).decode()
+        for k in range(1, count)
+    ]
+
+
+def follows(page, next_page):
+    """
+    Check that the next page starts one hour after the last price of the page.
+    """
+    if next_page is None or not page['nodes'] or not next_page['nodes']:
+        return False
+    last = datetime.datetime.fromisoformat(page['nodes'][-1]['startsAt'])
+    first = datetime.datetime.fromisoformat(next_page['nodes'][0]['startsAt'])
+    return first == last + datetime.timedelta(hours=1)
+
+
+async def fetch_all_price_info(api_token, after_cursor):
+    """
+    Fetch all price information from the Tibber API.
+
+    After the first page the cursors of the following pages are predicted and
+    PREFETCH_PAGES pages are requested concurrently. Predicted pages are only used
+    if they continue the previous page, otherwise fetching continues from the last
+    valid page.
 
-        # Pagination check
-        if not price_info['pageInfo']['hasNextPage']:
-            break
-        after_cursor = price_info['pageInfo']['endCursor']
+    The end cursors returned by Tibber are already base64 encoded strings and are
+    passed to the next request unchanged, only the initial timestamp is encoded
+    by the caller.
+
+    :param api_token: API token for authentication
+    :param after_cursor: Cursor for pagination in ISO format and base64 encoded
+    :return: List of all price info records
+    """
+    assert isinstance(after_cursor, str), "after_cursor must be a base64 encoded str"
+
+    all_price_info = []
+
+    headers = {
+        'Authorization': f'Bearer {api_token}',
+        'Content-Type': 'application/json'
+    }
+    timeout = aiohttp.ClientTimeout(total=PAGE_TIMEOUT)
+    async with aiohttp.ClientSession(headers=headers, timeout=timeout) as session:
+        page = await fetch_price_range_page(session, after_cursor)
+        while page is not None:
+            all_price_info.extend(page['nodes'])
+
+            # Pagination check
+            if not page['pageInfo']['hasNextPage']:
+                break
+
+            cursors = predict_cursors(page['pageInfo']['endCursor'], PREFETCH_PAGES)
+            pages = await asyncio.gather(*(fetch_price_range_page(session, cursor) for cursor in cursors))
+
+            # The first page uses the real end cursor, the predicted ones must continue it
+            page = pages[0]
+            for next_page in pages[1:]:
+                if page is None or not page['pageInfo']['hasNextPage'] or not follows(page, next_page):
+                    break
+                all_price_info.extend(page['nodes'])
+                page = next_page
+
+    # A failed page ends the pagination before the last price
+    if page is None:
+        logging.error("Fetching prices stopped early, only %s records were fetched", len(all_price_info))
 
     return all_price_info
 
-def store_in_influxdb(data, bucket_name, url, token, org):
+def store_in_influxdb(data, bucket_name):
     """
     Store the price information in an InfluxDB database.
 
     :param data: Data to store
-    :param bucket: Name of the InfluxDB bucket
-    :param url: Url of the InfluxDB instance
-    :param token: Token for InfluxDB authentication
-    :param org: Organization for InfluxDB
+    :param bucket_name: Name of the InfluxDB bucket
     """
-
-    client = InfluxDBClient(url=url, token=token, org=org)
     try:
-
-        # Create the database if it doesn't exist
-        bucket = client.buckets_api().find_bucket_by_name(bucket_name)
-        if bucket is None:
-            logging.error("Bucket %s does not exist", bucket_name)
-            return
-
-        # Convert data to InfluxDB format
-        influx_data = []
-        for record in data:
-            influx_record = {
-                "measurement": "energy_prices",
-                "tags": {
-                    "level": record['level']
-                },
-                "time": record['startsAt'],
-                "fields": {
-                    "total": float(record['total'])
-                }
-            }
-            influx_data.append(influx_record)
-
-        # Write data to InfluxDB
-        write_api = client.write_api(write_options=SYNCHRONOUS)
-        write_api.write(bucket=bucket_name, org=org, record=influx_data)
+        # Convert data to InfluxDB line protocol, prices start at full hours
+        lines = b"\n".join(
+            f"energy_prices,level={record['level']} total={float(record['total'])} "
+            f"{int(datetime.datetime.fromisoformat(record['startsAt']).timestamp())}".encode()
+            for record in data
+        )
+
+        # Queue data for the batched write to InfluxDB
+        influx_writer.write_points(bucket_name, lines, write_precision=WritePrecision.S)
     except Exception as e:
         logging.error("An error occurred while writing to InfluxDB: %s", e)
-    finally:
-        client.close()
 
 # Set up argparse for command line arguments
 parser = argparse.ArgumentParser(description='Fetch price information from Tibber API and store in InfluxDB.')
 parser.add_argument('--api_token', type=str, default=os.environ.get('API_TOKEN'), help='API token for the Tibber API')
 parser.add_argument('--timestamp', type=str, default=os.environ.get('TIMESTAMP', "today"), help='Timestamp in ISO format for the after cursor or "today" for today\'s prices')
+parser.add_argument('--timezone', type=str, default=os.environ.get('TIMEZONE', 'Europe/Berlin'), help='Timezone of the home, used to decide if tomorrow\'s prices are published')
 parser.add_argument('--influxdb_bucket', type=str, default=os.environ.get('INFLUXDB_BUCKET', 'energy'), help='Name of the InfluxDB bucket')
 parser.add_argument('--influxdb_url', type=str, default=os.environ.get('INFLUXDB_URL', 'http://localhost:8086'), help='Url of the InfluxDB instance')
 parser.add_argument('--influxdb_token', type=str, default=os.environ.get('INFLUX_TOKEN', ''), help='InfluxDB token')
@@ -194,24 +310,32 @@ args, unknown = parser.parse_known_args()
 LOGLEVEL = os.environ.get('LOGLEVEL', 'INFO').upper()
 logging.basicConfig(level=LOGLEVEL)
 
+# Check the InfluxDB bucket once before fetching
+influx_writer.init(args.influxdb_url, args.influxdb_token, args.influxdb_org)
+if not influx_writer.bucket_exists(args.influxdb_bucket):
+    influx_writer.close()
+    exit(-1)
+
 # Encode timestamp to base64 for after_cursor
 if args.timestamp == "today":
   logging.debug("Fetching today's price information")
-  price_info_records = fetch_price_info_today(args.api_token)
+  price_info_records = fetch_price_info_today(args.api_token, args.timezone)
 else:
   logging.debug("Fetching price information after %s", args.timestamp)
   after_cursor = base64.b64encode(args.timestamp.encode()).decode()
   # Fetch price information
-  price_info_records = fetch_all_price_info(args.api_token, after_cursor)
+  price_info_records = asyncio.run(fetch_all_price_info(args.api_token, after_cursor))
 
 if len(price_info_records) == 0:
     logging.info("No new records to fetch.")
+    influx_writer.close()
     exit()
 
 logging.info("Fetched %s records", len(price_info_records))
 
-# Store the records in the InfluxDB database
-store_in_influxdb(price_info_records, args.influxdb_bucket, args.influxdb_url, args.influxdb_token, args.influxdb_org)
+# Store the records in the InfluxDB database, closing the writer flushes the queued batch
+store_in_influxdb(price_info_records, args.influxdb_bucket)
+influx_writer.close()
 
 # print end timestamp of last entry
 print(f"Fetched {len(price_info_records)} records. Last entry: {price_info_records[-1]['startsAt']}")
\ No newline at end of file
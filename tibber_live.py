@@ -5,13 +5,20 @@ Script to fetch real-time consumption data from Tibber API and store in InfluxDB
 """
 
 import os
+import atexit
 import argparse
 import asyncio
 import aiohttp
+import collections
+import random
+import socket
+import time
 import tibber
 import datetime
+import functools
 import logging
-from influxdb_client import InfluxDBClient
+from concurrent.futures import ThreadPoolExecutor
+from influxdb_client import InfluxDBClient, Point, WriteOptions
 from influxdb_client.client.write_api import SYNCHRONOUS
 
 # Parse arguments and environment variables
@@ -21,6 +28,7 @@ parser.add_argument('--influxdb_realtime_bucket', type=str, default=os.environ.g
 parser.add_argument('--influxdb_url', type=str, default=os.environ.get('INFLUXDB_URL', 'http://localhost:8086'), help='Url of the InfluxDB instance')
 parser.add_argument('--influxdb_token', type=str, default=os.environ.get('INFLUX_TOKEN', ''), help='InfluxDB token')
 parser.add_argument('--influxdb_org', type=str, default=os.environ.get('INFLUX_ORG', 'myOrg'), help='InfluxDB organization')
+parser.add_argument('--influxdb_udp', type=str, default=os.environ.get('INFLUXDB_UDP'), help='Optional host:port of a UDP line protocol listener (InfluxDB 1.x or Telegraf) for the power values')
 args, unknown = parser.parse_known_args()
 
 # Set up logging
@@ -42,7 +50,7 @@ async def connect_tibber():
         await home.rt_subscribe(data_callback)
 
 # InfluxDB client setup
-client = InfluxDBClient(url=args.influxdb_url, token=args.influxdb_token, org=args.influxdb_org)
+client = InfluxDBClient(url=args.influxdb_url, token=args.influxdb_token, org=args.influxdb_org, enable_gzip=True)
 
  # Create the database if it doesn't exist
 bucket = client.buckets_api().find_bucket_by_name(args.influxdb_realtime_bucket)
@@ -50,6 +58,87 @@ if bucket is None:
     logging.error("Bucket %s does not exist", args.influxdb_realtime_bucket)
     exit(-1)
 
+# Batches which could not be written after all retries, written again later
+dead_letters = collections.deque(maxlen=10_000)
+
+# Delay in seconds between attempts to write the dead letters
+DEAD_LETTER_MIN_DELAY = 1
+DEAD_LETTER_MAX_DELAY = 30
+# Attempts to write a dead letter before it is dropped
+DEAD_LETTER_MAX_ATTEMPTS = 5
+
+# Only server errors, rate limiting and connection errors can succeed on a later attempt
+def is_retryable(exception):
+    status = getattr(exception, 'status', None)
+    if status is None and getattr(exception, 'response', None) is not None:
+        status = getattr(exception.response, 'status', None)
+    if status is None:
+        return True
+    return status == 429 or status >= 500
+
+# Callbacks for batches written in the background
+def write_success_callback(conf, data):
+    logging.debug("Data written to InfluxDB")
+
+def write_error_callback(conf, data, exception):
+    if not is_retryable(exception):
+        logging.error("Dropping batch which cannot be written to InfluxDB: {}".format(exception))
+        return
+    logging.warning("Error while writing to InfluxDB: {}".format(exception))
+    dead_letters.append((conf, data, 0))
+
+def write_done_callback(future):
+    if not future.cancelled() and future.exception() is not None:
+        logging.warning("Error while writing to InfluxDB: {}".format(future.exception()))
+
+# Reuse one batching write api for all real-time data
+write_api = client.write_api(
+    write_options=WriteOptions(batch_size=500, flush_interval=1_000, jitter_interval=200, retry_interval=5_000),
+    success_callback=write_success_callback,
+    error_callback=write_error_callback)
+retry_write_api = client.write_api(write_options=SYNCHRONOUS)
+
+# Single worker keeps the order of the writes and keeps them off the event loop
+write_executor = ThreadPoolExecutor(max_workers=1)
+
+# Fields of the live measurement stored in InfluxDB
+FIELDS = (
+    'power',
+    'powerProduction',
+    'lastMeterConsumption',
+    'lastMeterProduction',
+    'accumulatedConsumption',
+    'accumulatedProduction',
+    'accumulatedConsumptionLastHour',
+    'accumulatedProductionLastHour',
+)
+
+# Power values sent over UDP if a listener is configured, the remaining
+# meter and accumulated values are written over HTTP every ACCUMULATED_INTERVAL seconds
+UDP_FIELDS = ('power', 'powerProduction')
+ACCUMULATED_INTERVAL = 60
+
+udp_socket = None
+udp_address = None
+if args.influxdb_udp:
+    udp_host, udp_port = args.influxdb_udp.rsplit(':', 1)
+    udp_address = (udp_host, int(udp_port))
+    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    atexit.register(udp_socket.close)
+
+# Monotonic time of the last HTTP write while UDP is used
+last_http_write = None
+
+def send_udp(measurement):
+    timestamp = datetime.datetime.fromisoformat(measurement['timestamp'])
+    timestamp_ns = int(timestamp.timestamp()) * 1_000_000_000 + timestamp.microsecond * 1_000
+    fields = ",".join(f"{field}={float(measurement[field])}" for field in UDP_FIELDS)
+    line = f"tibber_LiveMeasurement {fields} {timestamp_ns}\n"
+    try:
+        udp_socket.sendto(line.encode(), udp_address)
+    except OSError as e:
+        logging.warning("Error while sending to UDP listener: {}".format(e))
+
 # Callback for real-time data
 def data_callback(pkg):
     logging.debug("Data received from Tibber")
@@ -59,31 +148,27 @@ def data_callback(pkg):
         return
     measurement = data.get("liveMeasurement")
     if measurement is not None:
-        json_body = [
-            {
-                "measurement": "tibber_LiveMeasurement",
-                "time": measurement['timestamp'],
-                "fields": {
-                    "power" : float(measurement['power']),
-                    "powerProduction" : float(measurement['powerProduction']),
-                    "lastMeterConsumption" : float(measurement['lastMeterConsumption']),
-                    "lastMeterProduction" : float(measurement['lastMeterProduction']),
-                    "accumulatedConsumption" : float(measurement['accumulatedConsumption']),
-                    "accumulatedProduction" : float(measurement['accumulatedProduction']),
-                    "accumulatedConsumptionLastHour" : float(measurement['accumulatedConsumptionLastHour']),
-                    "accumulatedProductionLastHour" : float(measurement['accumulatedProductionLastHour'])
-                }
-
-            }
-        ]
-        try:
-            write_api = client.write_api(write_options=SYNCHRONOUS)
-            write_api.write(bucket=args.influxdb_realtime_bucket, org=args.influxdb_org, record=json_body)
-
-            logging.debug("Data written to InfluxDB")
-        except Exception as e:
-            logging.warning("Error while writing to InfluxDB: {}".format(e))
-            exit(-1)
+        fields = FIELDS
+        if udp_socket is not None:
+            send_udp(measurement)
+            global last_http_write
+            now = time.monotonic()
+            if last_http_write is not None and now - last_http_write < ACCUMULATED_INTERVAL:
+                fields = ()
+            else:
+                last_http_write = now
+                fields = tuple(field for field in FIELDS if field not in UDP_FIELDS)
+        if fields:
+            point = Point("tibber_LiveMeasurement").time(measurement['timestamp'])
+            for field in fields:
+                value = measurement[field]
+                # JSON numbers without decimals are decoded as int, keep the fields float
+                if isinstance(value, int):
+                    value = float(value)
+                point.field(field, value)
+            write = functools.partial(write_api.write, bucket=args.influxdb_realtime_bucket, org=args.influxdb_org, record=point)
+            future = asyncio.get_running_loop().run_in_executor(write_executor, write)
+            future.add_done_callback(write_done_callback)
     else:
         logging.Warning("No liveMeasurement in data")
 
@@ -92,8 +177,31 @@ def data_callback(pkg):
     last_time_data_was_received = datetime.datetime.now()    
 
 
+# Write the dead letters again, backing off with jitter while InfluxDB keeps failing
+async def drain_dead_letters():
+    delay = DEAD_LETTER_MIN_DELAY
+    while True:
+        await asyncio.sleep(random.uniform(delay / 2, delay))
+        if not dead_letters:
+            continue
+        (bucket, org, precision), data, attempts = dead_letters.popleft()
+        write = functools.partial(retry_write_api.write, bucket=bucket, org=org, record=data, write_precision=precision)
+        try:
+            await asyncio.get_running_loop().run_in_executor(write_executor, write)
+            delay = DEAD_LETTER_MIN_DELAY
+            logging.info("Dead letter written to InfluxDB, %s remaining", len(dead_letters))
+        except Exception as e:
+            attempts += 1
+            if not is_retryable(e) or attempts >= DEAD_LETTER_MAX_ATTEMPTS:
+                logging.error("Dropping dead letter after {} attempts: {}".format(attempts, e))
+                continue
+            dead_letters.appendleft(((bucket, org, precision), data, attempts))
+            delay = min(delay * 2, DEAD_LETTER_MAX_DELAY)
+            logging.warning("Error while writing dead letter to InfluxDB: {}".format(e))
+
 # Main loop with reconnect logic
 async def main():
+    drain_task = asyncio.create_task(drain_dead_letters())
     await connect_tibber()
     while True:
         try:            
@@ -107,5 +215,20 @@ async def main():
             logging.error(f"Error: {e}")
             exit(-1)
 
+# Flush pending points before exiting, atexit runs after the interpreter
+# stopped accepting new threads and would lose them
+def shutdown():
+    write_executor.shutdown(wait=True)
+    write_api.close()
+    for (bucket, org, precision), data, attempts in list(dead_letters):
+        try:
+            retry_write_api.write(bucket=bucket, org=org, record=data, write_precision=precision)
+        except Exception as e:
+            logging.error("Dropping dead letter on exit: {}".format(e))
+    client.close()
+
 loop = asyncio.get_event_loop()
-loop.run_until_complete(main())
+try:
+    loop.run_until_complete(main())
+finally:
+    shutdown()
@@ -6,15 +6,19 @@ from smllib import SmlStreamReader
 from smllib.errors import CrcError
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 import time
 import argparse
 import logging
-import datetime
 
-from influxdb_client import InfluxDBClient
+from influxdb_client import WritePrecision
 from influxdb_client.client.write_api import SYNCHRONOUS
 
+from utils import influx_writer
+
+METER_ID_OBIS = "0100600100ff"
+
 obis_mapping = {
     "0100010800ff": {"name": "energy_total_import", "scale": 0.0001},
     "0100020800ff": {"name": "energy_total_export", "scale": 0.0001},
@@ -79,14 +83,23 @@ parser.add_argument(
 )
 args, unknown = parser.parse_known_args()
 
+# Delay in seconds between polls of the pulse while no complete frame is received or polling fails
+POLL_BACKOFF_MIN = 0.05
+POLL_BACKOFF_MAX = 1.0
+
 # Set up logging
 LOGLEVEL = os.environ.get("LOGLEVEL", "INFO").upper()
 logging.basicConfig(level=LOGLEVEL)
 
-def get_data(host, user, password):
-    response = requests.get(
-        f"http://{host}/data.json?node_id=1", auth=HTTPBasicAuth(user, password)
-    )
+def create_session(user, password):
+    session = requests.Session()
+    session.auth = HTTPBasicAuth(user, password)
+    session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+    return session
+
+
+def get_data(session, host):
+    response = session.get(f"http://{host}/data.json?node_id=1", timeout=2)
     if response.status_code == 200:
         # The response content will be in binary format
         return response.content
@@ -95,51 +108,57 @@ def get_data(host, user, password):
         return None
 
 
-def store_in_influxdb(
-    data, bucket_name: str, url: str, token: str, org: str, meter: str
-):
+def store_in_influxdb(data, bucket_name: str, meter: str):
     """
-    Store the price information in an InfluxDB database.
+    Store the meter values in an InfluxDB database.
 
     :param data: Data to store
-    :param bucket: Name of the InfluxDB bucket
-    :param url: Url of the InfluxDB instance
-    :param token: Token for InfluxDB authentication
-    :param org: Organization for InfluxDB
+    :param bucket_name: Name of the InfluxDB bucket
+    :param meter: Meter id used as tag
     """
 
-    now = datetime.datetime.utcnow().isoformat() + "Z"
-    client = InfluxDBClient(url=url, token=token, org=org)
+    now_ns = time.time_ns()
     try:
-        # Create the database if it doesn't exist
-        bucket = client.buckets_api().find_bucket_by_name(bucket_name)
-        if bucket is None:
-            logging.error("Bucket %s does not exist", bucket_name)
+        if not data:
+            logging.warning("No values to write")
             return
 
-        # Convert data to InfluxDB format
-        influx_data = []
-        influx_data.append(
-            {
-                "measurement": "meter_live",
-                "tags": {"meter": meter},
-                "time": now,
-                "fields": data,
-            }
+        # Convert data to InfluxDB line protocol, integers keep their field type
+        fields = ",".join(
+            f"{name}={value}i" if isinstance(value, int) else f"{name}={value}"
+            for name, value in data.items()
         )
+        tags = f",meter={meter}" if meter else ""
+        line = f"meter_live{tags} {fields} {now_ns}"
 
         # Write data to InfluxDB
-        write_api = client.write_api(write_options=SYNCHRONOUS)
-        write_api.write(bucket=bucket_name, org=org, record=influx_data)
+        influx_writer.write_points(
+            bucket_name, line, write_precision=WritePrecision.NS
+        )
     except Exception as e:
         logging.error("An error occurred while writing to InfluxDB: %s", e)
-    finally:
-        client.close()
 
 
+# Set up the InfluxDB client once, a reading is a single line so it is written synchronously
+influx_writer.init(
+    args.influxdb_url,
+    args.influxdb_token,
+    args.influxdb_org,
+    write_options=SYNCHRONOUS,
+)
+
+# Check the InfluxDB bucket once before polling
+if not influx_writer.bucket_exists(args.influxdb_realtime_bucket):
+    influx_writer.close()
+    exit(-1)
+
+# Poll the pulse with a keep-alive connection, backing off while no complete frame is received
+# or the pulse cannot be reached
+session = create_session(args.tibberhost_user, args.tibberhost_password)
+backoff = POLL_BACKOFF_MIN
 while True:
     try:
-        data = get_data(args.tibberhost, args.tibberhost_user, args.tibberhost_password)
+        data = get_data(session, args.tibberhost)
         if data:
             stream = SmlStreamReader()
             stream.add(data)
@@ -148,14 +167,13 @@ while True:
                 logging.debug(f"Bytes missing: {data}")
             else:
                 break
-        else:
-            time.sleep(0.1)
     except CrcError as e:
         logging.debug(f"CRCError msg: {e.crc_msg} calc: {e.crc_calc}")
-        pass
     except Exception as e:
         logging.debug("Error: %s", e)
-        pass
+    time.sleep(backoff)
+    backoff = min(backoff * 2, POLL_BACKOFF_MAX)
+session.close()
 
 
 # Shortcut to extract all values without parsing the whole frame
@@ -164,9 +182,8 @@ obis_values = sml_frame.get_obis()
 values = {}
 meter = ""
 for obis in obis_values:
-    obis_number = obis.obis
     obis_value = obis.value
-    if obis_number in "0100600100ff":
+    if obis.obis == METER_ID_OBIS:
         # parse meter number from string <LF><counter in hex><3 ASCII as HEX><3 digits number><HEX as integer>
         obis_value = obis_value[2:]
         meter_counter = int(obis_value[0:2])
@@ -174,18 +191,11 @@ for obis in obis_values:
         meter_unk = obis_value[8:11]
         meter_number = int(obis_value[11:], 16)
         meter = f"{meter_counter}{meter_man}{meter_unk}{meter_number}"
-
-    elif obis_number in obis_mapping:
-        values[obis_mapping[obis_number]["name"]] = round(
-            obis_value * obis_mapping[obis_number]["scale"], 3
-        )
+    else:
+        entry = obis_mapping.get(obis.obis)
+        if entry is not None:
+            values[entry["name"]] = round(obis_value * entry["scale"], 3)
 
 # Write to InfluxDB
-store_in_influxdb(
-    values,
-    args.influxdb_realtime_bucket,
-    args.influxdb_url,
-    args.influxdb_token,
-    args.influxdb_org,
-    meter,
-)
+store_in_influxdb(values, args.influxdb_realtime_bucket, meter)
+influx_writer.close()
@@ -0,0 +1,64 @@
+"""
+Shared InfluxDB client batching writes across calls.
+"""
+import logging
+from influxdb_client import InfluxDBClient, WriteOptions
+
+_client = None
+_write_api = None
+
+
+def init(url, token, org, write_options=None):
+    """
+    Create the shared InfluxDB client and its batching write api on first use.
+    Call close() before the script ends, otherwise queued points are lost.
+
+    :param url: Url of the InfluxDB instance
+    :param token: Token for InfluxDB authentication
+    :param org: Organization for InfluxDB
+    :param write_options: Write options, defaults to batches of 5000 points
+    :return: InfluxDB client
+    """
+    global _client, _write_api
+    if _client is None:
+        if write_options is None:
+            write_options = WriteOptions(batch_size=5000, flush_interval=10_000)
+        _client = InfluxDBClient(url=url, token=token, org=org, enable_gzip=True)
+        _write_api = _client.write_api(write_options=write_options)
+    return _client
+
+
+def bucket_exists(bucket_name):
+    """
+    Check once at startup that the bucket exists.
+
+    :param bucket_name: Name of the InfluxDB bucket
+    :return: True if the bucket exists
+    """
+    if _client.buckets_api().find_bucket_by_name(bucket_name) is None:
+        logging.error("Bucket %s does not exist", bucket_name)
+        return False
+    return True
+
+
+def write_points(bucket, records, **kwargs):
+    """
+    Queue records for writing, they are sent in batches in the background.
+
+    :param bucket: Name of the InfluxDB bucket
+    :param records: Points, line protocol or dicts to write
+    :param kwargs: Additional arguments for the write api, e.g. write_precision
+    """
+    _write_api.write(bucket=bucket, record=records, **kwargs)
+
+
+def close():
+    """
+    Flush pending points and close the shared client.
+    """
+    global _client, _write_api
+    if _client is not None:
+        _write_api.close()
+        _client.close()
+        _client = None
+        _write_api = None